@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Precomputes the binary tables used by pykache from the extracted PokeAPI dump.
+It is run by the Makefile once the dump has been extracted.
+"""
+
+import os
+import pickle
+import logging
+
+import tables
+
+DATA_DIR = 'data/'
+LOCALE = 'es' # Locale of the search terms, must match pykache.LOCALE
+DEFAULT_LOCALE = 'en' # Fallback locale of the flavor texts, idem
+
+logger = logging.getLogger(__name__)
+
+def load_resources(resource):
+	"""
+	Yields the data of every resource of the given kind in the dump, skipping
+	the name symlinks.
+	"""
+	path = DATA_DIR + resource + '/'
+	for filename in os.listdir(path):
+		if filename == 'name':
+			continue
+		with open(path + filename, 'rb') as f:
+			yield pickle.load(f)
+
+def build_stat_table():
+	rows = list()
+	for data in load_resources('pokemon'):
+		stats = {s['stat']['name'] : s['base_stat'] for s in data['stats']}
+		rows.append([data['id']] + [stats[name] for name in tables.STAT_COLUMNS[1:-1]])
+
+	tables.write_stat_table(DATA_DIR + 'stats.bin', rows)
+	logger.info('Stat table built: %d Pokemon', len(rows))
+
+def localised_name(data):
+	return [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
+
+def build_search_image():
+	search_dir = dict() # Search term -> handles
+	names = dict() # Handle -> API name
+
+	# Pokemon are searched by the localised name of their species
+	for data in load_resources('pokemon-species'):
+		handles = list()
+		for v in data['varieties']:
+			pid = int(v['pokemon']['url'].split('/')[-2])
+			handle = tables.make_handle(tables.KIND_POKEMON, pid)
+			names[handle] = v['pokemon']['name']
+			handles.append(handle)
+		search_dir[localised_name(data)] = handles
+
+	# Idem for moves
+	for data in load_resources('move'):
+		handle = tables.make_handle(tables.KIND_MOVE, data['id'])
+		names[handle] = data['name']
+		search_dir[localised_name(data)] = [handle]
+
+	tables.write_search_image(DATA_DIR + 'search.img', LOCALE, list(search_dir.items()), names)
+	logger.info('Search image built: %d terms', len(search_dir))
+
+def build_flavor_tables():
+	# Both tables share the list of version groups, so each one lists all of
+	# them, from oldest to newest
+	entities = {'move' : dict(), 'ability' : dict()}
+	locales = {'move' : set(), 'ability' : set()}
+	versions = dict() # Version group name -> id
+	for resource in entities:
+		for data in load_resources(resource):
+			texts = tables.index_flavor_texts(data['flavor_text_entries'])
+			entities[resource][data['id']] = texts
+			for l, by_version in texts.items():
+				locales[resource].add(l)
+				versions.update((v, vid) for v, (vid, _) in by_version.items())
+
+	versions = sorted(versions, key=versions.get)
+	for resource in entities:
+		tables.write_flavor_table(DATA_DIR + resource + '-flavor.img', entities[resource],
+		                          sorted(locales[resource]), versions, DEFAULT_LOCALE)
+		logger.info('Flavor text table built for %s: %d entries, %d locales, %d version groups',
+		            resource, len(entities[resource]), len(locales[resource]), len(versions))
+
+if __name__ == '__main__':
+	logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
+	                    level=logging.INFO)
+
+	build_stat_table()
+	build_search_image()
+	build_flavor_tables()
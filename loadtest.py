@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""
+Local load test of the update ingestion: synthetic updates are delivered
+through the webhook server and through long polling against a fake Bot API
+server, and the throughput and latency until they reach a handler are
+measured. No connection to Telegram is made.
+"""
+
+import argparse
+import http.client
+import http.server
+import json
+import threading
+import time
+
+import telegram
+from telegram.ext import Updater, Dispatcher, MessageHandler, Filters
+
+import webhook
+
+TOKEN = '123456:loadtest'
+SECRET_TOKEN = 'loadtest-secret'
+
+def synthetic_update(update_id):
+	"""
+	Returns an update with a text message, whose text is the time it was
+	created at.
+	"""
+	return {
+		'update_id' : update_id,
+		'message' : {
+			'message_id' : update_id,
+			'date' : int(time.time()),
+			'chat' : {'id' : update_id % 1000, 'type' : 'private'},
+			'from' : {'id' : update_id % 1000, 'is_bot' : False, 'first_name' : 'Test'},
+			'text' : repr(time.perf_counter()),
+		},
+	}
+
+def paced(first, options, start):
+	"""
+	Yields the update ids a sender sends, waiting between them so all the
+	senders together offer options.rate updates per second, if given.
+	"""
+	for i in range(first, options.updates, options.connections):
+		if options.rate:
+			delay = start + (i + 1) / options.rate - time.perf_counter()
+			if delay > 0:
+				time.sleep(delay)
+		yield i
+
+class Recorder:
+	"""
+	Handler collecting the latency of every update it receives.
+	"""
+
+	def __init__(self, expected):
+		self.expected = expected
+		self.latencies = list()
+		self.lock = threading.Lock()
+		self.done = threading.Event()
+
+	def __call__(self, bot, update):
+		latency = time.perf_counter() - float(update.message.text)
+		with self.lock:
+			self.latencies.append(latency)
+			if len(self.latencies) == self.expected:
+				self.done.set()
+
+	def report(self, name, elapsed):
+		ls = sorted(self.latencies)
+		percentile = lambda p : ls[min(len(ls) - 1, int(p * len(ls)))] * 1000
+		print('{0:8}: {1:6} updates, {2:8.0f} updates/s, latency p50 {3:.2f} ms, '
+		      'p99 {4:.2f} ms, max {5:.2f} ms'
+		      .format(name, len(ls), len(ls) / elapsed, percentile(0.5), percentile(0.99), ls[-1] * 1000))
+
+def run_webhook(options):
+	bot = telegram.Bot(TOKEN)
+	recorder = Recorder(options.updates)
+	dp = Dispatcher(bot, None, workers=0)
+	dp.add_handler(MessageHandler(Filters.text, recorder))
+
+	server = webhook.WebhookServer(('127.0.0.1', 0), '/' + TOKEN, SECRET_TOKEN,
+	                               lambda u : dp.process_update(telegram.Update.de_json(u, bot)),
+	                               workers=options.connections, max_connections=options.connections)
+	threading.Thread(target=server.serve_forever, daemon=True).start()
+
+	def client(first):
+		# One keep-alive connection per client, like Telegram does
+		conn = http.client.HTTPConnection(*server.server_address)
+		for i in paced(first, options, start):
+			conn.request('POST', '/' + TOKEN, json.dumps(synthetic_update(i)),
+			             {'Content-Type' : 'application/json',
+			              webhook.SECRET_HEADER : SECRET_TOKEN})
+			conn.getresponse().read()
+		conn.close()
+
+	start = time.perf_counter()
+	clients = [threading.Thread(target=client, args=(i,)) for i in range(options.connections)]
+	for c in clients:
+		c.start()
+	recorder.done.wait()
+	elapsed = time.perf_counter() - start
+
+	server.shutdown()
+	server.server_close()
+	recorder.report('webhook', elapsed)
+
+class FakeBotAPI(http.server.ThreadingHTTPServer):
+	"""
+	Serves getUpdates from a queue of pending updates, the way the Bot API
+	does: waiting up to the given timeout for at least one update.
+	"""
+
+	def __init__(self):
+		super().__init__(('127.0.0.1', 0), FakeBotAPIHandler)
+		self.pending = list()
+		self.next_id = 1
+		self.cond = threading.Condition()
+
+	def push(self, update):
+		with self.cond:
+			# Ids must grow in the order the updates are queued
+			update['update_id'] = self.next_id
+			self.next_id += 1
+			self.pending.append(update)
+			self.cond.notify_all()
+
+	def get_updates(self, offset, limit, timeout):
+		with self.cond:
+			self.pending = [u for u in self.pending if u['update_id'] >= offset]
+			self.cond.wait_for(lambda : self.pending, timeout)
+			return self.pending[:limit]
+
+class FakeBotAPIHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1'
+
+	def do_POST(self):
+		length = int(self.headers.get('Content-Length', 0))
+		body = self.rfile.read(length) if length else b''
+		params = json.loads(body.decode('utf-8')) if body else dict()
+
+		if self.path.endswith('/getUpdates'):
+			result = self.server.get_updates(int(params.get('offset') or 0),
+			                                 int(params.get('limit') or 100),
+			                                 float(params.get('timeout') or 0))
+		else: # deleteWebhook and the like
+			result = True
+
+		response = json.dumps({'ok' : True, 'result' : result}).encode('utf-8')
+		self.send_response(200)
+		self.send_header('Content-Type', 'application/json')
+		self.send_header('Content-Length', str(len(response)))
+		self.end_headers()
+		self.wfile.write(response)
+
+	def log_message(self, format, *args):
+		pass
+
+def run_polling(options):
+	api = FakeBotAPI()
+	threading.Thread(target=api.serve_forever, daemon=True).start()
+
+	recorder = Recorder(options.updates)
+	bot = telegram.Bot(TOKEN, base_url='http://{0}:{1}/bot'.format(*api.server_address))
+	updater = Updater(bot=bot)
+	updater.dispatcher.add_handler(MessageHandler(Filters.text, recorder))
+	updater.start_polling(timeout=10)
+
+	def producer(first):
+		for i in paced(first, options, start):
+			api.push(synthetic_update(i))
+
+	start = time.perf_counter()
+	producers = [threading.Thread(target=producer, args=(i,)) for i in range(options.connections)]
+	for p in producers:
+		p.start()
+	recorder.done.wait()
+	elapsed = time.perf_counter() - start
+
+	updater.stop()
+	api.shutdown()
+	api.server_close()
+	recorder.report('polling', elapsed)
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description=__doc__)
+	parser.add_argument('--updates', type=int, default=10000,
+	                    help='number of updates to send')
+	parser.add_argument('--connections', type=int, default=webhook.MAX_WORKERS,
+	                    help='concurrent senders (and webhook threads)')
+	parser.add_argument('--rate', type=float,
+	                    help='updates per second offered by all the senders together '
+	                         '(by default, as fast as possible)')
+	parser.add_argument('--mode', choices=('webhook', 'polling', 'both'), default='both')
+	options = parser.parse_args()
+
+	if options.mode in ('webhook', 'both'):
+		run_webhook(options)
+	if options.mode in ('polling', 'both'):
+		run_polling(options)
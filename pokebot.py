@@ -1,22 +1,55 @@
 #!/usr/bin/env python3
 
 import telegram
-from telegram.ext import Updater, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
+from telegram.ext import Updater, Dispatcher, CommandHandler, MessageHandler, CallbackQueryHandler, Filters
 import logging
+import argparse
+import re
+import secrets
+import ssl
+import urllib.parse
 
 import pykache
+import sharding
+import webhook
+
+# Stat names accepted by /top, as written by the users
+STAT_NAMES = {
+	'ps' : 'hp',
+	'ataque' : 'attack',
+	'defensa' : 'defense',
+	'ataque-especial' : 'special-attack',
+	'defensa-especial' : 'special-defense',
+	'velocidad' : 'speed',
+	'total' : 'total',
+}
+CONDITION_RE = re.compile(r'^([a-z-]+)(<=|>=|<|>|=)(\d+)$')
+TOP_DEFAULT_LIMIT = 10
+TOP_MAX_LIMIT = 50
+
+# Version group chosen by each chat with /version, by chat id
+chat_versions = dict()
+
+def chat_version(chat_id):
+	return chat_versions.get(chat_id, pykache.VERSION)
 
 def query(**kwargs):
 	"""
 	Receives a dictionary containing the query fields:
 		id : The Pokemon ID to retrieve
 		name : The Pokemon name to retrieve
+		move_name : The move name to retrieve
+		handle : The handle of the Pokemon or move to retrieve
+	and optionally:
+		version : The version group whose flavor texts are shown
 	Returns the corresponding pykache.Pokemon.
 	"""
 	p = None
 
 	try:
-		if 'id' in kwargs:
+		if 'handle' in kwargs:
+			p = pykache.get_by_handle(kwargs['handle'])
+		elif 'id' in kwargs:
 			p = pykache.get_pokemon_by_id(kwargs['id'])
 		elif 'name' in kwargs:
 			p = pykache.get_pokemon_by_name(kwargs['name'])
@@ -28,7 +61,7 @@ def query(**kwargs):
 	except ValueError: # Raised by the pykache module if the resource doesn't exist
 		return 'El recurso especificado no existe'
 
-	return p.human_readable()
+	return p.human_readable(kwargs.get('version', pykache.VERSION))
 
 def q_name(bot, update, args):
 	message = bot.send_message(chat_id=update.message.chat_id, text='Retomando información...')
@@ -36,7 +69,7 @@ def q_name(bot, update, args):
 	if len(args) != 1:
 		response = 'El comando /nombre toma un solo argumento'
 	else:
-		response = query(name=args[0])
+		response = query(name=args[0], version=chat_version(update.message.chat_id))
 
 	message.edit_text(text=response)
 
@@ -48,12 +81,7 @@ def q_fuzzy(bot, update):
 		bot.send_message(chat_id=update.message.chat_id,
 		                 text='No se ha encontrado ninguna coincidencia')
 	elif len(results) == 1:
-		r = results[0]
-		result_type, result_title = r.split(':')
-		if result_type == 'pokemon':
-			reply = query(name=result_title)
-		elif result_type == 'move':
-			reply = query(move_name=result_title)
+		reply = query(handle=results[0], version=chat_version(update.message.chat_id))
 
 		bot.send_message(chat_id=update.message.chat_id,
 		                 text=reply)
@@ -62,14 +90,14 @@ def q_fuzzy(bot, update):
 		inline_keyboard_buttons = list()
 
 		format_result = {
-			'pokemon' : 'Pokemon: ',
-			'move' : 'Movimiento: ',
+			pykache.KIND_POKEMON : 'Pokemon: ',
+			pykache.KIND_MOVE : 'Movimiento: ',
 		}
 		for r in results:
-			result_type, result_title = r.split(':')
-			button_text = format_result[result_type] + result_title.capitalize()
+			result_title = pykache.get_entity_name(r)
+			button_text = format_result[pykache.handle_kind(r)] + result_title.capitalize()
 			button = telegram.InlineKeyboardButton(text=button_text,
-			                                       callback_data='{0}'.format(r))
+			                                       callback_data=pykache.encode_handle(r))
 			inline_keyboard_buttons.append([button])
 		markup = telegram.InlineKeyboardMarkup(inline_keyboard_buttons)
 
@@ -84,25 +112,116 @@ def q_id(bot, update, args):
 	if (len(args) != 1) or (not args[0].isdigit()):
 		response = 'El comando /numero toma un solo argumento numérico'
 	else:
-		response = query(id=int(args[0]))
+		response = query(id=int(args[0]), version=chat_version(update.message.chat_id))
 
 	message.edit_text(text=response)
 
-def pokemon_search_callback(bot,update):
-	cb = update.callback_query
-	chat_id = cb['message']['chat']['id']
-	message = bot.send_message(chat_id=chat_id, text='Retomando información...')
-	response = query(name=cb['data'].split(':')[1])
+def q_top(bot, update, args):
+	"""
+	Lists the Pokemon with the highest value of a stat, optionally filtered by
+	conditions on other stats, e.g.: /top velocidad 5 ataque>100
+	"""
+	message = bot.send_message(chat_id=update.message.chat_id, text='Retomando información...')
+	usage = 'Uso: /top <estadística> [cantidad] [condiciones]\n'\
+	        'Ejemplo: /top velocidad 5 ataque>100\n'\
+	        'Estadísticas: ' + ', '.join(STAT_NAMES.keys())
+
+	if len(args) == 0 or args[0].lower() not in STAT_NAMES:
+		message.edit_text(text=usage)
+		return
+
+	order_by = STAT_NAMES[args[0].lower()]
+	limit = TOP_DEFAULT_LIMIT
+	conditions = list()
+	for arg in args[1:]:
+		m = CONDITION_RE.match(arg.lower())
+		if arg.isdigit():
+			limit = min(int(arg), TOP_MAX_LIMIT)
+		elif m is not None and m.group(1) in STAT_NAMES:
+			conditions.append((STAT_NAMES[m.group(1)], m.group(2), int(m.group(3))))
+		else:
+			message.edit_text(text=usage)
+			return
+
+	try:
+		results = pykache.query_stats(conditions, order_by=order_by, limit=limit)
+	except ValueError:
+		message.edit_text(text='Las estadísticas no están disponibles')
+		return
+
+	if len(results) == 0:
+		message.edit_text(text='No se ha encontrado ninguna coincidencia')
+		return
+
+	# Labelled with the API name, which tells apart the forms of a species
+	# and doesn't need to load any Pokemon
+	response = ''
+	for i, (pid, value) in enumerate(results, 1):
+		try:
+			name = pykache.get_entity_name(pykache.make_handle(pykache.KIND_POKEMON, pid))
+		except KeyError: # Not in the search index
+			name = '#{0}'.format(pid)
+		response += '{0}. {1}: {2}\n'.format(i, name.capitalize(), value)
+
 	message.edit_text(text=response)
 
-def move_search_callback(bot,update):
+def q_version(bot, update, args):
+	"""
+	Sets the version group whose flavor texts are shown in this chat, or lists
+	the available ones if none is given.
+	"""
+	chat_id = update.message.chat_id
+	versions = pykache.get_versions()
+
+	if len(args) == 1 and args[0].lower() in versions:
+		chat_versions[chat_id] = args[0].lower()
+		response = 'Versión cambiada a ' + args[0].lower()
+	else:
+		response  = 'Versión actual: {0}\n'.format(chat_version(chat_id))
+		response += 'Uso: /version <versión>\n'
+		response += 'Versiones: ' + ', '.join(reversed(versions))
+
+	bot.send_message(chat_id=chat_id, text=response)
+
+def search_callback(bot,update):
 	cb = update.callback_query
 	chat_id = cb['message']['chat']['id']
 	message = bot.send_message(chat_id=chat_id, text='Retomando información...')
-	response = query(move_name=cb['data'].split(':')[1])
+	response = query(handle=pykache.decode_handle(cb['data']), version=chat_version(chat_id))
 	message.edit_text(text=response)
 
+def register_handlers(dp):
+	dp.add_handler(CommandHandler("nombre", q_name, pass_args=True))
+	dp.add_handler(CommandHandler("id", q_id, pass_args=True))
+	dp.add_handler(CommandHandler("top", q_top, pass_args=True))
+	dp.add_handler(CommandHandler("version", q_version, pass_args=True))
+	dp.add_handler(CallbackQueryHandler(search_callback, pattern=r'^[pm]\d+$'))
+	dp.add_handler(MessageHandler(Filters.text, q_fuzzy))
+
 if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Pokemon Telegram bot')
+	parser.add_argument('--workers', type=int, default=0,
+	                    help='number of worker processes (by default, a single process handles everything)')
+	parser.add_argument('--webhook', metavar='URL',
+	                    help='receive the updates at this public HTTPS URL instead of polling. '
+	                         'Without --cert, a proxy terminating TLS must forward them to the server')
+	parser.add_argument('--listen', default='0.0.0.0',
+	                    help='address the webhook server listens on')
+	parser.add_argument('--port', type=int, default=8443,
+	                    help='port the webhook server listens on')
+	parser.add_argument('--threads', type=int, default=webhook.MAX_WORKERS,
+	                    help='updates the webhook server handles at the same time')
+	parser.add_argument('--connections', type=int, default=webhook.MAX_CONNECTIONS,
+	                    help='connections the webhook server keeps open, the rest are closed')
+	parser.add_argument('--cert', metavar='PEM',
+	                    help='certificate of the webhook server, uploaded to Telegram so it can be self-signed')
+	parser.add_argument('--key', metavar='PEM',
+	                    help='private key of the certificate')
+	options = parser.parse_args()
+	if options.connections < options.threads:
+		# Telegram opens up to --threads connections, they must all be accepted
+		parser.error('--connections must be at least --threads')
+
 	# Load token
 	TOKEN_FILE = 'token.txt'
 	TOKEN = ''
@@ -115,22 +234,64 @@ if __name__ == '__main__':
 
 	logger = logging.getLogger(__name__)
 
-	# Create the EventHandler and pass the bot's token.
-	updater = Updater(TOKEN)
+	if options.workers > 0:
+		# The updates are received here and handled by the worker processes
+		supervisor = sharding.Supervisor(TOKEN, register_handlers, options.workers)
+		supervisor.start()
+		bot = supervisor.bot
+		handle_update = supervisor.dispatch
+	elif options.webhook:
+		bot = telegram.Bot(TOKEN)
+		dp = Dispatcher(bot, None, workers=0)
+		register_handlers(dp)
+		handle_update = lambda update : dp.process_update(telegram.Update.de_json(update, bot))
 
-	# Get the dispatcher to register handlers
-	dp = updater.dispatcher
+	if options.webhook:
+		ssl_context = None
+		if options.cert:
+			ssl_context = ssl.create_default_context(ssl.Purpose.CLIENT_AUTH)
+			ssl_context.load_cert_chain(options.cert, options.key)
 
-	dp.add_handler(CommandHandler("nombre", q_name, pass_args=True))
-	dp.add_handler(CommandHandler("id", q_id, pass_args=True))
-	dp.add_handler(CallbackQueryHandler(pokemon_search_callback, pattern='pokemon:(.*)'))
-	dp.add_handler(CallbackQueryHandler(move_search_callback, pattern='move:(.*)'))
-	dp.add_handler(MessageHandler(Filters.text, q_fuzzy))
+		# Sent back by Telegram with every update, so no one else can post them
+		secret_token = secrets.token_urlsafe(32)
+		server = webhook.WebhookServer((options.listen, options.port),
+		                               urllib.parse.urlsplit(options.webhook).path or '/',
+		                               secret_token, handle_update, workers=options.threads,
+		                               max_connections=options.connections, ssl_context=ssl_context)
+
+		if options.cert:
+			with open(options.cert, 'rb') as certificate:
+				bot.set_webhook(url=options.webhook, certificate=certificate,
+				                max_connections=options.threads, secret_token=secret_token)
+		else:
+			bot.set_webhook(url=options.webhook, max_connections=options.threads,
+			                secret_token=secret_token)
+		try:
+			server.serve_forever()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			server.server_close()
+			if options.workers > 0:
+				supervisor.stop()
+	elif options.workers > 0:
+		try:
+			supervisor.poll()
+		except KeyboardInterrupt:
+			pass
+		finally:
+			supervisor.stop()
+	else:
+		# Create the EventHandler and pass the bot's token.
+		updater = Updater(TOKEN)
+
+		# Get the dispatcher to register handlers
+		register_handlers(updater.dispatcher)
 
-	# Start the Bot
-	updater.start_polling()
+		# Start the Bot
+		updater.start_polling()
 
-	# Run the bot until the you presses Ctrl-C or the process receives SIGINT,
-	# SIGTERM or SIGABRT. This should be used most of the time, since
-	# start_polling() is non-blocking and will stop the bot gracefully.
-	updater.idle()
+		# Run the bot until the you presses Ctrl-C or the process receives SIGINT,
+		# SIGTERM or SIGABRT. This should be used most of the time, since
+		# start_polling() is non-blocking and will stop the bot gracefully.
+		updater.idle()
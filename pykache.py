@@ -6,8 +6,12 @@ requests already made.
 import requests
 import bisect
 from sorted_collection import SortedCollection
+import tables
+from tables import KIND_POKEMON, KIND_MOVE, make_handle, handle_kind, handle_id
 import pickle
 import os
+import sys
+import threading
 import logging
 
 BASE_URL = "http://pokeapi.co/api/v2/"
@@ -35,6 +39,9 @@ MOVE_CLASS_SYMBOL = {
 	'status' : '\N{LARGE ORANGE DIAMOND}',
 }
 
+KIND_PREFIXES = ('p', 'm') # Kind prefixes in the encoded handles
+KIND_BY_PREFIX = {prefix : kind for kind, prefix in enumerate(KIND_PREFIXES)}
+
 logger = logging.getLogger(__name__)
 
 class MoveData:
@@ -44,7 +51,8 @@ class MoveData:
 	"""
 	def __init__(self, data):
 		self.data = data
-		self.name = data['name'] # Fetches the name to make searches faster
+		self.id = data['id']
+		self.name = sys.intern(data['name']) # Fetches the name to make searches faster
 
 		# Localised name
 		self.l_name = [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
@@ -53,31 +61,34 @@ class MoveData:
 		self.power = data['power']
 		self.pp = data['pp']
 		self.accuracy = data['accuracy']
-		self.flavor_text = None
+		self.flavor_texts = None # Flavor texts by locale and version group
 
 	def get_localised_name(self):
 		return self.l_name
 
-	def get_flavor_text(self):
-		if self.flavor_text is None:
-			fts = self.data['flavor_text_entries']
-			for ft in fts:
-				if ft['language']['name'] == LOCALE and \
-				   ft['version_group']['name'] == VERSION:
-
-					self.flavor_text = ft['flavor_text']
-					break
+	def get_flavor_text(self, version=VERSION):
+		"""
+		Returns the flavor text for the given version group. If it has none,
+		the text from the newest version group is returned instead.
+		"""
+		if move_flavor is not None:
+			try:
+				return move_flavor.text(self.id, LOCALE, version)
+			except KeyError: # Move added to the dump after the table was built
+				pass
 
-		return self.flavor_text
+		if self.flavor_texts is None:
+			self.flavor_texts = tables.index_flavor_texts(self.data['flavor_text_entries'])
+		return tables.resolve_flavor_text(self.flavor_texts, LOCALE, version, DEFAULT_LOCALE)
 
-	def human_readable(self):
+	def human_readable(self, version=VERSION):
 		r  = self.get_localised_name() + '\n'
 		r += 'Tipo: {0} , Clase: {1} {2}\n'\
 		     .format(self.type.get_localised_name(), MOVE_CLASS_NAMES[self.move_class], MOVE_CLASS_SYMBOL[self.move_class])
 
 		if self.move_class != 'status':
 			r += 'Potencia: {0} , Precisión: {1}\n'.format(self.power, self.accuracy)
-		r += self.get_flavor_text() + '\n'
+		r += self.get_flavor_text(version) + '\n'
 		return r
 
 class AbilityData:
@@ -88,26 +99,30 @@ class AbilityData:
 
 	def __init__(self, data):
 		self.data = data
-		self.name = data['name'] # Fetches the name to make searches faster
+		self.id = data['id']
+		self.name = sys.intern(data['name']) # Fetches the name to make searches faster
 
 		# Localised name
 		self.l_name = [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
-		self.flavor_text = None
+		self.flavor_texts = None # Flavor texts by locale and version group
 
 	def get_localised_name(self):
 		return self.l_name
 
-	def get_flavor_text(self):
-		if self.flavor_text is None:
-			fts = self.data['flavor_text_entries']
-			for ft in fts:
-				if ft['language']['name'] == LOCALE and \
-				   ft['version_group']['name'] == VERSION:
-
-					self.flavor_text = ft['flavor_text']
-					break
+	def get_flavor_text(self, version=VERSION):
+		"""
+		Returns the flavor text for the given version group. If it has none,
+		the text from the newest version group is returned instead.
+		"""
+		if ability_flavor is not None:
+			try:
+				return ability_flavor.text(self.id, LOCALE, version)
+			except KeyError: # Ability added to the dump after the table was built
+				pass
 
-		return self.flavor_text
+		if self.flavor_texts is None:
+			self.flavor_texts = tables.index_flavor_texts(self.data['flavor_text_entries'])
+		return tables.resolve_flavor_text(self.flavor_texts, LOCALE, version, DEFAULT_LOCALE)
 
 # Represents an empty slot (for when a )
 class NoAbilityData(AbilityData):
@@ -117,6 +132,7 @@ class NoAbilityData(AbilityData):
 	"""
 	def __init__(self):
 		self.data = None
+		self.id = None
 		self.name = None
 		self.l_name = None
 
@@ -128,7 +144,7 @@ class TypeData:
 
 	def __init__(self, data):
 		self.data = data
-		self.name = data['name'] # Fetches the name to make searches faster
+		self.name = sys.intern(data['name']) # Fetches the name to make searches faster
 
 		# Localised name
 		self.l_name = [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
@@ -147,7 +163,7 @@ class PokemonData:
 		""" Creates a Pokemon entry given its data (but doesn't save it)"""
 		self.data = data
 		self.id = data['id']     # Fetches the id to make searches faster
-		self.name = data['name'] # Idem for the name
+		self.name = sys.intern(data['name']) # Idem for the name
 
 		# Unpopulated data
 		self.types = None # Pokemon's types
@@ -181,6 +197,12 @@ class PokemonData:
 		return self.h_ability
 
 	def get_stats(self):
+		if stat_table is not None:
+			try:
+				return stat_table.get_stats(self.id)
+			except ValueError: # Pokemon added to the dump after the table was built
+				pass
+
 		sts = [(s['stat']['name'], s['base_stat']) for s in self.data['stats']]
 		return [s[1] for s in sorted(sts, key=lambda x : ORDERED_STATS[x[0]])]
 
@@ -197,10 +219,10 @@ class PokemonData:
 
 		return self.l_name
 
-	def human_readable(self):
+	def human_readable(self, version=VERSION):
 		"""
 		Returns the Pokemon data in human readable form, intended to be sent to
-		a user.
+		a user. The abilities are described as in the given version group.
 		"""
 		s =  self.get_localised_name() + '\n'
 		s += 'Tipos: ' + ', '.join((t.get_localised_name() for t in self.get_types())) + '\n\n'
@@ -208,11 +230,11 @@ class PokemonData:
 		# Abilities
 		s += 'Habilidades:\n'
 		for a in self.get_abilities():
-			s += '- {0}: {1}\n'.format(a.get_localised_name(), a.get_flavor_text())
+			s += '- {0}: {1}\n'.format(a.get_localised_name(), a.get_flavor_text(version))
 
 		h_a = self.get_hidden_ability()
 		if h_a.name is not None:
-			s += '- {0} (Oculta): {1}\n'.format(h_a.get_localised_name(), h_a.get_flavor_text()) # Rellenar
+			s += '- {0} (Oculta): {1}\n'.format(h_a.get_localised_name(), h_a.get_flavor_text(version)) # Rellenar
 		s += '\n'
 
 		#Stats
@@ -229,7 +251,6 @@ class PokemonData:
 
 
 pokemon_list = list()
-pokemon_sorted_id   = SortedCollection(key=lambda poke : poke.id)
 pokemon_sorted_name = SortedCollection(key=lambda poke : poke.name)
 
 type_list = list()
@@ -241,24 +262,60 @@ ability_sorted_name = SortedCollection(key=lambda ability : ability.name)
 move_list = list()
 move_sorted_name = SortedCollection(key=lambda move : move.name)
 
+# Loaded Pokemon and moves by handle, which also indexes them by id
+entity_cache = dict()
+
+# The caches are used from several threads when using the webhook. The lock is
+# held from the lookup to the insertion, so an entity is only loaded once and
+# no index is read halfway through an update. It is reentrant because loading
+# an entity may load others, e.g. the type of a move.
+cache_lock = threading.RLock()
+
+def encode_handle(handle):
+	"""
+	Encodes a handle as a short string, e.g. to be sent as callback data.
+	"""
+	return KIND_PREFIXES[handle_kind(handle)] + str(handle_id(handle))
+
+def decode_handle(s):
+	"""
+	Decodes a handle encoded by encode_handle. Raises ValueError if the string
+	is not a valid handle.
+	"""
+	try:
+		return make_handle(KIND_BY_PREFIX[s[0]], int(s[1:]))
+	except (KeyError, IndexError):
+		raise ValueError('Invalid handle: ' + s)
+
+def get_entity_name(handle):
+	"""
+	Returns the API name of an entity given its handle. Raises KeyError if the
+	handle is not in the search index.
+	"""
+	return search_image.entity_name(handle)
+
 def insert_pokemon(pokemon):
-	pokemon_list.append(pokemon)
+	with cache_lock:
+		pokemon_list.append(pokemon)
 
-	# Create indices
-	pokemon_sorted_id.insert(pokemon)
-	pokemon_sorted_name.insert(pokemon)
+		# Create indices
+		pokemon_sorted_name.insert(pokemon)
+		entity_cache[make_handle(KIND_POKEMON, pokemon.id)] = pokemon
 
 def insert_ability(ability):
-	ability_list.append(ability)
+	with cache_lock:
+		ability_list.append(ability)
 
-	#Create indices
-	ability_sorted_name.insert(ability)
+		#Create indices
+		ability_sorted_name.insert(ability)
 
 def insert_move(move):
-	move_list.append(move)
+	with cache_lock:
+		move_list.append(move)
 
-	#Create indices
-	move_sorted_name.insert(move)
+		#Create indices
+		move_sorted_name.insert(move)
+		entity_cache[make_handle(KIND_MOVE, move.id)] = move
 
 def get_pokemon_by_id(pid):
 	"""
@@ -268,19 +325,20 @@ def get_pokemon_by_id(pid):
 
 	assert type(pid) == int, "A Pokemon's ID must be an integer"
 
-	try:
-		return pokemon_sorted_id.find(pid)
-	except ValueError: # Data not requested
+	with cache_lock:
 		try:
-			f = open(DATA_DIR + 'pokemon/' + str(pid), 'rb')
-		except FileNotFoundError:
-			raise ValueError # ID doesn't exist
-		else:
-			data = pickle.load(f)
-			f.close()
-			p = PokemonData(data)
-			insert_pokemon(p)
-			return p
+			return entity_cache[make_handle(KIND_POKEMON, pid)]
+		except KeyError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'pokemon/' + str(pid), 'rb')
+			except FileNotFoundError:
+				raise ValueError # ID doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
+				p = PokemonData(data)
+				insert_pokemon(p)
+				return p
 
 def get_pokemon_by_name(name):
 	"""
@@ -290,26 +348,28 @@ def get_pokemon_by_name(name):
 
 	assert type(name) == str, "A Pokemon's name must be a string"
 
-	try:
-		return pokemon_sorted_name.find(name)
-	except ValueError: # Data not requested
+	with cache_lock:
 		try:
-			f = open(DATA_DIR + 'pokemon/name/' + name, 'rb')
-		except FileNotFoundError:
-			raise ValueError # Name doesn't exist
-		else:
-			data = pickle.load(f)
-			f.close()
-			p = PokemonData(data)
-			insert_pokemon(p)
-			return p
+			return pokemon_sorted_name.find(name)
+		except ValueError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'pokemon/name/' + name, 'rb')
+			except FileNotFoundError:
+				raise ValueError # Name doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
+				p = PokemonData(data)
+				insert_pokemon(p)
+				return p
 
 
 def insert_type(ptype):
-	type_list.append(ptype)
+	with cache_lock:
+		type_list.append(ptype)
 
-	# Create indices
-	type_sorted_name.insert(ptype)
+		# Create indices
+		type_sorted_name.insert(ptype)
 
 def get_type_by_name(name):
 	"""
@@ -319,20 +379,21 @@ def get_type_by_name(name):
 
 	assert type(name) == str, "A Type's name must be a string"
 
-	try:
-		return type_sorted_name.find(name)
-	except ValueError: # Data not requested
+	with cache_lock:
 		try:
-			f = open(DATA_DIR + 'type/' + name, 'rb')
-		except FileNotFoundError:
-			raise ValueError # Name doesn't exist
-		else:
-			data = pickle.load(f)
-			f.close()
+			return type_sorted_name.find(name)
+		except ValueError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'type/' + name, 'rb')
+			except FileNotFoundError:
+				raise ValueError # Name doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
 
-		t = TypeData(data)
-		insert_type(t)
-		return t
+			t = TypeData(data)
+			insert_type(t)
+			return t
 
 def get_ability_by_name(name):
 	"""
@@ -342,20 +403,21 @@ def get_ability_by_name(name):
 
 	assert type(name) == str, "An ability's name must be a string"
 
-	try:
-		return ability_sorted_name.find(name)
-	except ValueError: # Data not requested
+	with cache_lock:
 		try:
-			f = open(DATA_DIR + 'ability/name/' + name, 'rb')
-		except FileNotFoundError:
-			raise ValueError # Name doesn't exist
-		else:
-			data = pickle.load(f)
-			f.close()
+			return ability_sorted_name.find(name)
+		except ValueError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'ability/name/' + name, 'rb')
+			except FileNotFoundError:
+				raise ValueError # Name doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
 
-		a = AbilityData(data)
-		insert_ability(a)
-		return a
+			a = AbilityData(data)
+			insert_ability(a)
+			return a
 
 def get_move_by_name(name):
 	"""
@@ -365,71 +427,165 @@ def get_move_by_name(name):
 
 	assert type(name) == str, "A move's name must be a string"
 
-	try:
-		return move_sorted_name.find(name)
-	except ValueError: # Data not requested
+	with cache_lock:
 		try:
-			f = open(DATA_DIR + 'move/name/' + name, 'rb')
-		except FileNotFoundError:
-			raise ValueError # Name doesn't exist
-		else:
-			data = pickle.load(f)
-			f.close()
+			return move_sorted_name.find(name)
+		except ValueError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'move/name/' + name, 'rb')
+			except FileNotFoundError:
+				raise ValueError # Name doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
 
-		m = MoveData(data)
-		insert_move(m)
-		return m
+			m = MoveData(data)
+			insert_move(m)
+			return m
 
-# Fuzzy find
-search_dir = dict()
+def get_move_by_id(mid):
+	"""
+	Gets a Move data given its id. Raises ValueError if the ID doesn't exist.
+	Raises AssertError if the value is not an integer.
+	"""
 
-# Create a list with the Pokemons' localised names
-SPECIES_DIR = 'data/pokemon-species/'
-files = os.listdir(SPECIES_DIR)
-files.remove('name')
+	assert type(mid) == int, "A move's ID must be an integer"
 
-for filename in files:
-	path = SPECIES_DIR + filename
-	with open(path, 'rb') as f:
-		data = pickle.load(f)
-	localised_name = [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
-	varieties = ['pokemon:' + v['pokemon']['name'] for v in data['varieties']]
+	with cache_lock:
+		try:
+			return entity_cache[make_handle(KIND_MOVE, mid)]
+		except KeyError: # Data not requested
+			try:
+				f = open(DATA_DIR + 'move/' + str(mid), 'rb')
+			except FileNotFoundError:
+				raise ValueError # ID doesn't exist
+			else:
+				data = pickle.load(f)
+				f.close()
 
-	search_dir[localised_name] = varieties
+			m = MoveData(data)
+			insert_move(m)
+			return m
 
-# Idem for moves
-MOVES_DIR = 'data/move/'
-files = os.listdir(MOVES_DIR)
-files.remove('name')
+def get_by_handle(handle):
+	"""
+	Gets a Pokemon or Move data given its handle. Raises ValueError if the
+	entity doesn't exist.
+	"""
+	try:
+		return entity_cache[handle]
+	except KeyError: # Data not requested
+		kind = handle_kind(handle)
+		if kind == KIND_POKEMON:
+			return get_pokemon_by_id(handle_id(handle))
+		elif kind == KIND_MOVE:
+			return get_move_by_id(handle_id(handle))
+		else:
+			raise ValueError('Unknown entity kind: {0}'.format(kind))
 
-for filename in files:
-	path = MOVES_DIR + filename
-	with open(path, 'rb') as f:
-		data = pickle.load(f)
-	localised_name = [n['name'] for n in data['names'] if n['language']['name'] == LOCALE][0]
+# Base stats table
+STATS_FILE = DATA_DIR + 'stats.bin'
+try:
+	stat_table = tables.StatTable.load(STATS_FILE)
+except FileNotFoundError:
+	logger.warning('Stat table not found, run build_tables.py to create it')
+	stat_table = None
 
-	search_dir[localised_name] = ['move:' + data['name']]
+def query_stats(conditions=(), order_by='total', limit=None, descending=True):
+	"""
+	Searches the Pokemon by their base stats. conditions is a list of
+	(stat, operator, value) tuples that every result must satisfy, operator
+	being one of '<', '<=', '=', '>=' or '>'. The results are sorted by the
+	order_by stat and at most limit of them are returned. Returns a list of
+	(Pokemon ID, value of order_by) tuples. Raises ValueError if the stat
+	table hasn't been built and KeyError if a stat or an operator doesn't
+	exist.
+	"""
+	if stat_table is None:
+		raise ValueError('The stat table has not been built')
+
+	rows = stat_table.filter(conditions)
+	if limit is None:
+		rows = stat_table.sort(order_by, rows, descending)
+	else:
+		rows = stat_table.top(order_by, limit, rows, descending)
+
+	ids = stat_table.column('id')
+	values = stat_table.column(order_by)
+	return [(ids[r], values[r]) for r in rows]
+
+# Flavor text tables
+MOVE_FLAVOR_FILE = DATA_DIR + 'move-flavor.img'
+ABILITY_FLAVOR_FILE = DATA_DIR + 'ability-flavor.img'
+try:
+	move_flavor = tables.FlavorTable.load(MOVE_FLAVOR_FILE)
+	ability_flavor = tables.FlavorTable.load(ABILITY_FLAVOR_FILE)
+except FileNotFoundError:
+	logger.warning('Flavor text tables not found, run build_tables.py to create them')
+	move_flavor = None
+	ability_flavor = None
+
+available_versions = None # Cached by get_versions
+
+def get_versions():
+	"""
+	Returns the names of the version groups with flavor texts for moves or
+	abilities, from oldest to newest.
+	"""
+	global available_versions
+
+	if available_versions is None:
+		if move_flavor is not None:
+			versions = list(move_flavor.versions)
+			versions += [v for v in ability_flavor.versions if v not in versions]
+		else: # Without the tables, they are read from the data once
+			ids = dict()
+			for resource in ('move', 'ability'):
+				path = DATA_DIR + resource + '/'
+				for filename in os.listdir(path):
+					if filename == 'name':
+						continue
+					with open(path + filename, 'rb') as f:
+						data = pickle.load(f)
+					for ft in data['flavor_text_entries']:
+						vg = ft['version_group']
+						ids[vg['name']] = int(vg['url'].split('/')[-2])
+			versions = sorted(ids, key=ids.get)
+		available_versions = versions
+
+	return list(available_versions)
 
-logger.info('Search terms created') #Doesn't work?
+# Fuzzy find
+SEARCH_FILE = DATA_DIR + 'search.img'
+try:
+	search_image = tables.SearchImage.load(SEARCH_FILE)
+except FileNotFoundError:
+	# Unlike the other tables, the bot can't work without it
+	sys.exit('Search index not found, run build_tables.py to create it')
+if search_image.locale != LOCALE:
+	logger.warning('The search index was built for locale %s, run build_tables.py again',
+	               search_image.locale)
+
+logger.info('Search terms loaded')
 
 def fuzzy_find(term):
 	"""
-	Performs a fuzzy search in the search_dir given a search term. This term
+	Performs a fuzzy search in the search index given a search term. This term
 	is split into keywords and tried to match the registered entries. Returns
-	a list of tuples containing the names for matching entries in order	of
+	a list containing the handles of the matching entries in order of
 	similarity.
 	"""
 	keywords = [k.lower() for k in term.split()] # Make lowercase for easy comparison
 
 	matches = list()
-	for entry in search_dir.keys():
-		e = entry.lower()
+	for i in range(len(search_image)):
+		e = search_image.term(i) # Already lowercase
 		if e in keywords:
-			matches = search_dir[entry] + matches # Add to beginning
+			matches = search_image.term_handles(i) + matches # Add to beginning
 		else:
 			for k in keywords:
 				if k in e: # If the keyword is a substring of the entry
-					matches = matches + search_dir[entry]
+					matches = matches + search_image.term_handles(i)
 					break # Do not check any more keywords (avoid repeated entries)
 
 	return matches
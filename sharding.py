@@ -0,0 +1,195 @@
+"""
+Sharded deployment of the bot. A supervisor process receives the updates and
+fans them out to a number of worker processes by chat id, so that the updates
+of a chat are always handled, in order, by the same worker.
+
+The workers don't load the data on their own: pykache maps its tables and
+search index read-only, so every process shares the same pages of memory.
+"""
+
+import multiprocessing
+import logging
+import queue
+import threading
+import time
+
+import telegram
+from telegram.ext import Dispatcher
+
+QUEUE_SIZE = 1024 # Pending updates per worker before they are dropped
+POLL_TIMEOUT = 10 # Seconds of long polling
+RETRY_DELAY = 5 # Seconds to wait after a network error
+HEALTH_CHECK_INTERVAL = 1 # Seconds between checks of the workers
+HUNG_TIMEOUT = 30 # Seconds a worker with pending updates may go without handling one
+STOP_TIMEOUT = 10 # Seconds given to the workers to finish when stopping
+
+# The supervisor is multi-threaded (the webhook server and the health checks),
+# and forking a multi-threaded process can leave locks held in the child
+MP_CONTEXT = multiprocessing.get_context('spawn')
+
+logger = logging.getLogger(__name__)
+
+def chat_id_of(update):
+	"""
+	Returns the id of the chat an update belongs to, given the update as a
+	dictionary. Updates without a chat are keyed by their sender, and by 0 if
+	they have none.
+	"""
+	for key in ('message', 'edited_message', 'channel_post', 'edited_channel_post'):
+		if key in update:
+			return update[key]['chat']['id']
+
+	if 'callback_query' in update and 'message' in update['callback_query']:
+		return update['callback_query']['message']['chat']['id']
+
+	for value in update.values():
+		if isinstance(value, dict) and 'from' in value:
+			return value['from']['id']
+
+	return 0
+
+def worker_main(token, register_handlers, queue, progress):
+	"""
+	Entry point of a worker process: handles the updates it receives through
+	queue until it receives None, counting them in progress.
+	"""
+	bot = telegram.Bot(token)
+	dispatcher = Dispatcher(bot, None, workers=0)
+	register_handlers(dispatcher)
+
+	while True:
+		data = queue.get()
+		if data is None:
+			break
+		try:
+			dispatcher.process_update(telegram.Update.de_json(data, bot))
+		except Exception: # A bad update must not take down the whole shard
+			logger.exception('Error while handling update %s', data.get('update_id'))
+		progress.value += 1
+
+class Supervisor:
+	"""
+	Starts the worker processes and distributes the updates among them.
+	register_handlers is called by every worker with its dispatcher, so it must
+	be a module level function. A health check thread restarts the workers
+	that die or stop handling their updates.
+	"""
+
+	def __init__(self, token, register_handlers, workers):
+		assert workers > 0, "At least one worker is needed"
+
+		self.token = token
+		self.register_handlers = register_handlers
+		self.bot = telegram.Bot(token)
+		self.queues = [None] * workers
+		self.processes = [None] * workers
+		self.progress = [None] * workers # Updates handled by each worker
+		self.last_progress = [None] * workers # (Updates handled, time they've been pending since)
+		self.lock = threading.Lock() # dispatch() is called from several threads with the webhook
+		self.stopping = threading.Event()
+		self.monitor = threading.Thread(target=self.check_workers, daemon=True)
+
+	def spawn(self, i):
+		with self.lock:
+			old = self.queues[i]
+			# The queue of a dead worker may be left locked, so it is not reused
+			self.queues[i] = MP_CONTEXT.Queue(QUEUE_SIZE)
+			if old is not None:
+				# The updates still pending go to the new worker, unless the
+				# queue is locked (get_nowait() doesn't wait for the lock)
+				try:
+					while True:
+						self.queues[i].put_nowait(old.get_nowait())
+				except queue.Empty:
+					pass
+				# Otherwise exiting would wait for its unsent updates
+				old.cancel_join_thread()
+				old.close()
+
+		self.progress[i] = MP_CONTEXT.Value('Q', 0, lock=False)
+		self.last_progress[i] = (0, None)
+		self.processes[i] = MP_CONTEXT.Process(target=worker_main,
+		                                       args=(self.token, self.register_handlers,
+		                                             self.queues[i], self.progress[i]),
+		                                       daemon=True)
+		self.processes[i].start()
+
+	def start(self):
+		for i in range(len(self.processes)):
+			self.spawn(i)
+		self.monitor.start()
+		logger.info('Started %d workers', len(self.processes))
+
+	def stop(self):
+		self.stopping.set()
+		self.monitor.join()
+		for q, p in zip(self.queues, self.processes):
+			try:
+				q.put_nowait(None)
+			except queue.Full:
+				p.terminate()
+		for p in self.processes:
+			p.join(STOP_TIMEOUT)
+			if p.is_alive():
+				p.terminate()
+				p.join()
+
+	def check_workers(self):
+		"""
+		Restarts, every HEALTH_CHECK_INTERVAL seconds, the workers that died
+		and the ones that have had pending updates for HUNG_TIMEOUT seconds
+		without handling any. Workers are only started from this thread.
+		"""
+		while not self.stopping.wait(HEALTH_CHECK_INTERVAL):
+			now = time.monotonic()
+			for i, p in enumerate(self.processes):
+				handled = self.progress[i].value
+				last, since = self.last_progress[i]
+				if self.queues[i].empty():
+					since = None
+				elif handled != last or since is None:
+					since = now
+				self.last_progress[i] = (handled, since)
+
+				if not p.is_alive():
+					logger.error('Worker %d died with exit code %s, restarting it', i, p.exitcode)
+				elif since is not None and now - since >= HUNG_TIMEOUT:
+					logger.error('Worker %d is hung, restarting it', i)
+					p.terminate()
+					p.join()
+				else:
+					continue
+				self.spawn(i)
+
+	def dispatch(self, update):
+		"""
+		Sends an update, given as a dictionary, to the worker of its chat.
+		It never blocks: the update is dropped if the worker has QUEUE_SIZE
+		updates pending, so a stuck worker can't stall the others.
+		"""
+		i = chat_id_of(update) % len(self.queues)
+		try:
+			with self.lock:
+				self.queues[i].put_nowait(update)
+		except queue.Full:
+			logger.error('Worker %d is falling behind, update %s dropped', i, update.get('update_id'))
+
+	def poll(self):
+		"""
+		Receives the updates through long polling until interrupted.
+		"""
+		self.bot.delete_webhook() # Polling is refused while a webhook is set
+		offset = None
+		while True:
+			try:
+				updates = self.bot.get_updates(offset=offset, timeout=POLL_TIMEOUT)
+			except telegram.error.TimedOut:
+				continue
+			except telegram.error.NetworkError as e:
+				logger.warning('Error while polling: %s', e)
+				time.sleep(RETRY_DELAY)
+				continue
+
+			for u in updates:
+				self.dispatch(u.to_dict())
+				offset = u.update_id + 1
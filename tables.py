@@ -0,0 +1,388 @@
+"""
+This module defines the binary tables precomputed from the PokeAPI dump by
+build_tables.py. They are memory-mapped by pykache instead of unpickling every
+resource, so loading them costs no parsing and their pages are shared by every
+process that maps them.
+"""
+
+import array
+import bisect
+import heapq
+import itertools
+import mmap
+import operator
+import struct
+
+# Entity handles. Searchable entities are referred to by a (kind, id) pair
+# packed into a single int, instead of by 'kind:name' strings.
+KIND_POKEMON = 0
+KIND_MOVE = 1
+HANDLE_ID_BITS = 24
+HANDLE_ID_MASK = (1 << HANDLE_ID_BITS) - 1
+
+def make_handle(kind, eid):
+	return (kind << HANDLE_ID_BITS) | eid
+
+def handle_kind(handle):
+	return handle >> HANDLE_ID_BITS
+
+def handle_id(handle):
+	return handle & HANDLE_ID_MASK
+
+# Column order of the stat table. 'total' is the sum of the six base stats.
+STAT_COLUMNS = (
+	'id',
+	'hp',
+	'attack',
+	'defense',
+	'special-attack',
+	'special-defense',
+	'speed',
+	'total',
+)
+
+STAT_MAGIC = b'PKST'
+# magic, number of columns, number of rows (padded to keep the columns aligned)
+STAT_HEADER = struct.Struct('<4sII4x')
+
+# Comparison operators accepted in the filter conditions
+OPERATORS = {
+	'<'  : operator.lt,
+	'<=' : operator.le,
+	'='  : operator.eq,
+	'>=' : operator.ge,
+	'>'  : operator.gt,
+}
+
+def write_stat_table(path, rows):
+	"""
+	Writes a stat table given an iterable of rows, each one being the Pokemon
+	id followed by its six base stats in the order of STAT_COLUMNS. The total
+	is computed here.
+	"""
+	rows = sorted(rows, key=lambda r : r[0])
+	rows = [list(r) + [sum(r[1:])] for r in rows]
+
+	with open(path, 'wb') as f:
+		f.write(STAT_HEADER.pack(STAT_MAGIC, len(STAT_COLUMNS), len(rows)))
+		for c in range(len(STAT_COLUMNS)):
+			array.array('i', (r[c] for r in rows)).tofile(f)
+
+class StatTable:
+	"""
+	Columnar table of base stats: one int column per entry of STAT_COLUMNS,
+	with the rows sorted by Pokemon id. Conditions and orderings are evaluated
+	a whole column at a time instead of Pokemon by Pokemon.
+	"""
+
+	def __init__(self, buf):
+		magic, ncols, nrows = STAT_HEADER.unpack_from(buf, 0)
+		if magic != STAT_MAGIC or ncols != len(STAT_COLUMNS):
+			raise ValueError('Not a stat table')
+
+		size = array.array('i').itemsize * ncols * nrows
+		view = memoryview(buf)[STAT_HEADER.size:STAT_HEADER.size + size].cast('i')
+
+		self.buf = buf # Keeps the mapping alive
+		self.rows = nrows
+		self.columns = {name : view[i*nrows:(i+1)*nrows] for i, name in enumerate(STAT_COLUMNS)}
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Maps the table stored in path. Raises FileNotFoundError if it has not
+		been built.
+		"""
+		with open(path, 'rb') as f:
+			buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(buf)
+
+	def column(self, name):
+		"""
+		Returns the column for the given stat name. Raises KeyError if the stat
+		doesn't exist.
+		"""
+		return self.columns[name]
+
+	def row_of(self, pid):
+		"""
+		Returns the row index of a Pokemon given its id. Raises ValueError if
+		the id is not in the table.
+		"""
+		ids = self.columns['id']
+		i = bisect.bisect_left(ids, pid)
+		if i == self.rows or ids[i] != pid:
+			raise ValueError('No stats for Pokemon {0}'.format(pid))
+		return i
+
+	def get_stats(self, pid):
+		"""
+		Returns the six base stats of a Pokemon, in the order of ORDERED_STATS.
+		"""
+		i = self.row_of(pid)
+		return [self.columns[name][i] for name in STAT_COLUMNS[1:-1]]
+
+	def filter(self, conditions):
+		"""
+		Returns the indices of the rows matching every condition, given as
+		(stat, operator, value) tuples, where operator is a key of OPERATORS.
+		"""
+		mask = itertools.repeat(True, self.rows)
+		for stat, op, value in conditions:
+			hits = map(OPERATORS[op], self.column(stat), itertools.repeat(value))
+			mask = list(map(operator.and_, mask, hits))
+		return list(itertools.compress(range(self.rows), mask))
+
+	def sort(self, stat, rows, descending=True):
+		"""
+		Sorts the given row indices by a stat.
+		"""
+		return sorted(rows, key=self.column(stat).__getitem__, reverse=descending)
+
+	def top(self, stat, k, rows, descending=True):
+		"""
+		Returns the k row indices with the highest (or lowest) value of a stat.
+		"""
+		select = heapq.nlargest if descending else heapq.nsmallest
+		return select(k, rows, key=self.column(stat).__getitem__)
+
+SEARCH_MAGIC = b'PKSI'
+# magic, locale of the search terms, number of search terms, number of
+# handles, number of named entities
+SEARCH_HEADER = struct.Struct('<4s8sIII4x')
+
+def _write_strings(f, strings):
+	"""
+	Writes the offsets array of a list of strings. Returns the encoded blob,
+	which must be written at the end of the image.
+	"""
+	encoded = [s.encode('utf-8') for s in strings]
+	offsets = array.array('I', [0])
+	for e in encoded:
+		offsets.append(offsets[-1] + len(e))
+	offsets.tofile(f)
+	return b''.join(encoded)
+
+def write_search_image(path, locale, terms, names):
+	"""
+	Writes the search index image. terms is a list of (search term, handles)
+	pairs and names a dictionary with the API name of every handle. Search
+	terms are stored in lowercase, since that is how they are compared.
+	"""
+	handles = sorted(names)
+
+	with open(path, 'wb') as f:
+		f.write(SEARCH_HEADER.pack(SEARCH_MAGIC, locale.encode('ascii'), len(terms),
+		                           sum(len(hs) for _, hs in terms), len(handles)))
+
+		offsets = array.array('I', [0])
+		for _, hs in terms:
+			offsets.append(offsets[-1] + len(hs))
+		offsets.tofile(f)
+		array.array('I', (h for _, hs in terms for h in hs)).tofile(f)
+		array.array('I', handles).tofile(f)
+
+		terms_blob = _write_strings(f, [t.lower() for t, _ in terms])
+		names_blob = _write_strings(f, [names[h] for h in handles])
+		f.write(terms_blob)
+		f.write(names_blob)
+
+class SearchImage:
+	"""
+	Read-only search index: the lowercase search terms, the handles each of
+	them leads to and the API names of those handles. Nothing is decoded until
+	it is accessed, so mapping it is cheap and its pages are shared between
+	processes.
+	"""
+
+	def __init__(self, buf):
+		magic, locale, nterms, nhandles, nnames = SEARCH_HEADER.unpack_from(buf, 0)
+		if magic != SEARCH_MAGIC:
+			raise ValueError('Not a search image')
+
+		self.buf = buf # Keeps the mapping alive
+		self.locale = locale.rstrip(b'\0').decode('ascii')
+		self.terms = nterms
+		view = memoryview(buf)
+		pos = SEARCH_HEADER.size
+
+		def take(n):
+			nonlocal pos
+			size = array.array('I').itemsize * n
+			section = view[pos:pos + size].cast('I')
+			pos += size
+			return section
+
+		self.handle_offsets = take(nterms + 1)
+		self.handles = take(nhandles)
+		self.name_handles = take(nnames)
+		self.term_offsets = take(nterms + 1)
+		self.name_offsets = take(nnames + 1)
+		self.terms_blob = view[pos:pos + self.term_offsets[-1]]
+		pos += self.term_offsets[-1]
+		self.names_blob = view[pos:pos + self.name_offsets[-1]]
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Maps the image stored in path. Raises FileNotFoundError if it has not
+		been built.
+		"""
+		with open(path, 'rb') as f:
+			buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(buf)
+
+	def __len__(self):
+		return self.terms
+
+	def term(self, i):
+		"""
+		Returns the i-th search term, in lowercase.
+		"""
+		return str(self.terms_blob[self.term_offsets[i]:self.term_offsets[i+1]], 'utf-8')
+
+	def term_handles(self, i):
+		"""
+		Returns a list with the handles the i-th search term leads to.
+		"""
+		return self.handles[self.handle_offsets[i]:self.handle_offsets[i+1]].tolist()
+
+	def entity_name(self, handle):
+		"""
+		Returns the API name of an entity given its handle. Raises KeyError if
+		the handle is not in the image.
+		"""
+		i = bisect.bisect_left(self.name_handles, handle)
+		if i == len(self.name_handles) or self.name_handles[i] != handle:
+			raise KeyError(handle)
+		return str(self.names_blob[self.name_offsets[i]:self.name_offsets[i+1]], 'utf-8')
+
+FLAVOR_MAGIC = b'PKFT'
+# magic, number of locales, number of version groups, number of entities,
+# size of the id index, number of distinct texts, index of the default locale
+FLAVOR_HEADER = struct.Struct('<4sIIIIIi')
+
+def index_flavor_texts(entries):
+	"""
+	Indexes the flavor_text_entries of a resource returned by PokeAPI.
+	Returns a dictionary {locale : {version group : (version group id, text)}}.
+	"""
+	texts = dict()
+	for ft in entries:
+		vg = ft['version_group']
+		texts.setdefault(ft['language']['name'], dict())[vg['name']] = \
+			(int(vg['url'].split('/')[-2]), ft['flavor_text'])
+	return texts
+
+def resolve_flavor_text(texts, locale, version, default_locale):
+	"""
+	Returns the flavor text for a locale and version group from a dictionary
+	created by index_flavor_texts. When there is none for that version group,
+	the one from the newest version group is used, and if the locale has no
+	texts at all the same is tried with default_locale. Returns an empty
+	string if nothing is found.
+	"""
+	for l in (locale, default_locale):
+		by_version = texts.get(l)
+		if by_version:
+			if version in by_version:
+				return by_version[version][1]
+			return max(by_version.values())[1]
+	return ''
+
+def write_flavor_table(path, entities, locales, versions, default_locale):
+	"""
+	Writes a flavor text table. entities is a dictionary with the texts of
+	every entity id, as returned by index_flavor_texts, and versions must be
+	sorted from oldest to newest. The fallbacks are resolved here, so every
+	cell holds the text that will be shown.
+	"""
+	ids = sorted(entities)
+	row_of_id = array.array('i', [-1] * (ids[-1] + 1 if ids else 0))
+	strings = {'' : 0}
+	cells = array.array('I')
+	for row, eid in enumerate(ids):
+		row_of_id[eid] = row
+		for l in locales:
+			for v in versions:
+				text = resolve_flavor_text(entities[eid], l, v, default_locale)
+				cells.append(strings.setdefault(text, len(strings)))
+
+	default_index = locales.index(default_locale) if default_locale in locales else -1
+	with open(path, 'wb') as f:
+		f.write(FLAVOR_HEADER.pack(FLAVOR_MAGIC, len(locales), len(versions), len(ids),
+		                           len(row_of_id), len(strings), default_index))
+		row_of_id.tofile(f)
+		cells.tofile(f)
+		# Dictionaries keep the insertion order, i.e. the string indices
+		names_blob = _write_strings(f, list(locales) + list(versions))
+		texts_blob = _write_strings(f, list(strings))
+		f.write(names_blob)
+		f.write(texts_blob)
+
+class FlavorTable:
+	"""
+	Flavor texts of every (entity, locale, version group), with the fallbacks
+	already applied, so a lookup is just indexing.
+	"""
+
+	def __init__(self, buf):
+		magic, nlocales, nversions, nrows, nids, nstrings, default_index = \
+			FLAVOR_HEADER.unpack_from(buf, 0)
+		if magic != FLAVOR_MAGIC:
+			raise ValueError('Not a flavor text table')
+
+		self.buf = buf # Keeps the mapping alive
+		view = memoryview(buf)
+		pos = FLAVOR_HEADER.size
+
+		def take(fmt, n):
+			nonlocal pos
+			size = array.array(fmt).itemsize * n
+			section = view[pos:pos + size].cast(fmt)
+			pos += size
+			return section
+
+		self.row_of_id = take('i', nids)
+		self.cells = take('I', nrows * nlocales * nversions)
+		name_offsets = take('I', nlocales + nversions + 1)
+		self.text_offsets = take('I', nstrings + 1)
+
+		names_blob = view[pos:pos + name_offsets[-1]]
+		pos += name_offsets[-1]
+		self.texts_blob = view[pos:pos + self.text_offsets[-1]]
+
+		names = [str(names_blob[name_offsets[i]:name_offsets[i+1]], 'utf-8')
+		         for i in range(nlocales + nversions)]
+		self.locales = {l : i for i, l in enumerate(names[:nlocales])}
+		self.versions = names[nlocales:]
+		self.version_index = {v : i for i, v in enumerate(self.versions)}
+		self.default_locale = default_index
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Maps the table stored in path. Raises FileNotFoundError if it has not
+		been built.
+		"""
+		with open(path, 'rb') as f:
+			buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		return cls(buf)
+
+	def text(self, eid, locale, version):
+		"""
+		Returns the flavor text of an entity given its id. Locales without
+		texts fall back to the default locale, and unknown version groups to
+		the newest one. Raises KeyError if the entity is not in the table.
+		"""
+		row = self.row_of_id[eid] if 0 <= eid < len(self.row_of_id) else -1
+		if row < 0:
+			raise KeyError(eid)
+
+		l = self.locales.get(locale, self.default_locale)
+		if l < 0:
+			return ''
+		v = self.version_index.get(version, len(self.versions) - 1)
+
+		s = self.cells[(row * len(self.locales) + l) * len(self.versions) + v]
+		return str(self.texts_blob[self.text_offsets[s]:self.text_offsets[s+1]], 'utf-8')
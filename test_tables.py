@@ -0,0 +1,174 @@
+"""
+Round-trip tests of the binary tables written by build_tables.py: every table
+is written to a temporary file and mapped back.
+"""
+
+import os
+import tempfile
+import unittest
+
+import tables
+
+def flavor_entry(locale, version, version_id, text):
+	return {
+		'language' : {'name' : locale},
+		'version_group' : {
+			'name' : version,
+			'url' : 'https://pokeapi.co/api/v2/version-group/{0}/'.format(version_id),
+		},
+		'flavor_text' : text,
+	}
+
+class TableTestCase(unittest.TestCase):
+	def setUp(self):
+		self.dir = tempfile.TemporaryDirectory()
+		self.path = os.path.join(self.dir.name, 'table')
+
+	def tearDown(self):
+		self.dir.cleanup()
+
+class StatTableTest(TableTestCase):
+	def setUp(self):
+		super().setUp()
+		# Unsorted, to check that the rows are sorted by id
+		tables.write_stat_table(self.path, [
+			[150, 106, 110, 90, 154, 90, 130],
+			[25, 35, 55, 40, 50, 50, 90],
+			[1, 45, 49, 49, 65, 65, 45],
+		])
+		self.table = tables.StatTable.load(self.path)
+		self.ids = self.table.column('id')
+
+	def test_round_trip(self):
+		self.assertEqual(self.table.rows, 3)
+		self.assertEqual(list(self.ids), [1, 25, 150])
+		self.assertEqual(self.table.get_stats(25), [35, 55, 40, 50, 50, 90])
+		self.assertEqual(list(self.table.column('total')), [318, 320, 680])
+
+	def test_missing_id(self):
+		for pid in (0, 2, 151):
+			with self.assertRaises(ValueError):
+				self.table.row_of(pid)
+			with self.assertRaises(ValueError):
+				self.table.get_stats(pid)
+
+	def test_filter(self):
+		self.assertEqual(self.table.filter([]), [0, 1, 2])
+		self.assertEqual(self.table.filter([('attack', '>', 50)]), [1, 2])
+		self.assertEqual(self.table.filter([('attack', '>', 50), ('speed', '<=', 90)]), [1])
+		self.assertEqual(self.table.filter([('hp', '=', 1)]), [])
+
+	def test_sort(self):
+		rows = self.table.sort('speed', range(self.table.rows))
+		self.assertEqual([self.ids[r] for r in rows], [150, 25, 1])
+		rows = self.table.sort('speed', range(self.table.rows), descending=False)
+		self.assertEqual([self.ids[r] for r in rows], [1, 25, 150])
+
+	def test_top(self):
+		rows = self.table.top('speed', 2, range(self.table.rows))
+		self.assertEqual([self.ids[r] for r in rows], [150, 25])
+		rows = self.table.top('speed', 2, range(self.table.rows), descending=False)
+		self.assertEqual([self.ids[r] for r in rows], [1, 25])
+		self.assertEqual(self.table.top('speed', 2, []), [])
+
+	def test_not_a_stat_table(self):
+		path = os.path.join(self.dir.name, 'zeros') # self.path is mapped
+		with open(path, 'wb') as f:
+			f.write(b'\0' * 64)
+		with self.assertRaises(ValueError):
+			tables.StatTable.load(path)
+
+class SearchImageTest(TableTestCase):
+	def setUp(self):
+		super().setUp()
+		self.pikachu = tables.make_handle(tables.KIND_POKEMON, 25)
+		self.rock_star = tables.make_handle(tables.KIND_POKEMON, 10080)
+		self.thunderbolt = tables.make_handle(tables.KIND_MOVE, 85)
+		tables.write_search_image(self.path, 'es', [
+			('Pikachu', [self.pikachu, self.rock_star]),
+			('Rayo', [self.thunderbolt]),
+			('Poción', []),
+		], {
+			self.thunderbolt : 'thunderbolt',
+			self.pikachu : 'pikachu',
+			self.rock_star : 'pikachu-rock-star',
+		})
+		self.image = tables.SearchImage.load(self.path)
+
+	def test_round_trip(self):
+		self.assertEqual(self.image.locale, 'es')
+		self.assertEqual(len(self.image), 3)
+		self.assertEqual([self.image.term(i) for i in range(3)], ['pikachu', 'rayo', 'poción'])
+		self.assertEqual(self.image.term_handles(0), [self.pikachu, self.rock_star])
+		self.assertEqual(self.image.term_handles(1), [self.thunderbolt])
+		self.assertEqual(self.image.term_handles(2), [])
+
+	def test_entity_name(self):
+		self.assertEqual(self.image.entity_name(self.pikachu), 'pikachu')
+		self.assertEqual(self.image.entity_name(self.rock_star), 'pikachu-rock-star')
+		self.assertEqual(self.image.entity_name(self.thunderbolt), 'thunderbolt')
+
+	def test_unknown_handle(self):
+		for handle in (0, tables.make_handle(tables.KIND_POKEMON, 26),
+		               tables.make_handle(tables.KIND_MOVE, 86)):
+			with self.assertRaises(KeyError):
+				self.image.entity_name(handle)
+
+	def test_handles(self):
+		handle = tables.make_handle(tables.KIND_MOVE, 85)
+		self.assertEqual(tables.handle_kind(handle), tables.KIND_MOVE)
+		self.assertEqual(tables.handle_id(handle), 85)
+
+class FlavorTableTest(TableTestCase):
+	def setUp(self):
+		super().setUp()
+		thunderbolt = tables.index_flavor_texts([
+			flavor_entry('es', 'x-y', 15, 'Rayo XY'),
+			flavor_entry('en', 'x-y', 15, 'Thunderbolt XY'),
+			flavor_entry('en', 'sun-moon', 17, 'Thunderbolt SM'),
+		])
+		shadow = tables.index_flavor_texts([
+			flavor_entry('en', 'x-y', 15, 'Shadow XY'),
+		])
+		tables.write_flavor_table(self.path, {85 : thunderbolt, 10001 : shadow},
+		                          ['en', 'es'], ['x-y', 'sun-moon'], 'en')
+		self.table = tables.FlavorTable.load(self.path)
+
+	def test_exact(self):
+		self.assertEqual(self.table.versions, ['x-y', 'sun-moon'])
+		self.assertEqual(self.table.text(85, 'es', 'x-y'), 'Rayo XY')
+		self.assertEqual(self.table.text(85, 'en', 'sun-moon'), 'Thunderbolt SM')
+
+	def test_version_fallback(self):
+		# Newest version group of the same locale
+		self.assertEqual(self.table.text(85, 'es', 'sun-moon'), 'Rayo XY')
+		# Unknown version groups are treated as the newest one
+		self.assertEqual(self.table.text(85, 'en', 'ultra-sun-ultra-moon'), 'Thunderbolt SM')
+
+	def test_locale_fallback(self):
+		# Locale in the table without texts for this entity
+		self.assertEqual(self.table.text(10001, 'es', 'x-y'), 'Shadow XY')
+		self.assertEqual(self.table.text(10001, 'es', 'sun-moon'), 'Shadow XY')
+		# Locale missing from the table
+		self.assertEqual(self.table.text(85, 'fr', 'x-y'), 'Thunderbolt XY')
+		self.assertEqual(self.table.text(85, 'fr', 'sun-moon'), 'Thunderbolt SM')
+
+	def test_missing_id(self):
+		for eid in (-1, 0, 86, 10002):
+			with self.assertRaises(KeyError):
+				self.table.text(eid, 'en', 'x-y')
+
+	def test_no_default_locale(self):
+		path = os.path.join(self.dir.name, 'no-default') # self.path is mapped
+		tables.write_flavor_table(path, {1 : tables.index_flavor_texts([
+			flavor_entry('es', 'x-y', 15, 'Solo español'),
+		])}, ['es'], ['x-y'], 'en')
+		table = tables.FlavorTable.load(path)
+		self.assertEqual(table.text(1, 'es', 'x-y'), 'Solo español')
+		self.assertEqual(table.text(1, 'fr', 'x-y'), '')
+
+	def test_resolve_without_texts(self):
+		self.assertEqual(tables.resolve_flavor_text({}, 'es', 'x-y', 'en'), '')
+
+if __name__ == '__main__':
+	unittest.main()
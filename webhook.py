@@ -0,0 +1,157 @@
+"""
+Webhook ingestion: an HTTP server which receives the updates pushed by Telegram
+and passes them to a callback, as an alternative to long polling.
+
+Every connection gets its own thread and is kept alive between updates, but
+idle connections are closed after a few seconds, connections over a fixed
+number are closed as soon as they are accepted, so slow clients can't take up
+an unbounded number of threads, and at most a fixed number of updates are
+handled at the same time. Requests must carry the secret token given to
+Telegram in set_webhook.
+
+Telegram only delivers updates over HTTPS. Either give the server a
+certificate, which is then also uploaded with set_webhook so self-signed ones
+work, or put it behind a proxy that terminates TLS.
+"""
+
+import hmac
+import http.server
+import json
+import logging
+import socket
+import ssl
+import threading
+
+MAX_WORKERS = 8 # Updates handled at the same time
+MAX_CONNECTIONS = 4 * MAX_WORKERS # Open connections (and threads), idle ones included
+MAX_BODY_SIZE = 64 * 1024 # Bytes accepted per update
+KEEP_ALIVE_TIMEOUT = 5 # Seconds an idle connection is kept open
+SECRET_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+logger = logging.getLogger(__name__)
+
+class WebhookHandler(http.server.BaseHTTPRequestHandler):
+	protocol_version = 'HTTP/1.1' # Needed for keep-alive
+	timeout = KEEP_ALIVE_TIMEOUT
+
+	def setup(self):
+		super().setup()
+		if isinstance(self.request, ssl.SSLSocket):
+			# Done here rather than on accept, so a slow client doesn't block
+			# the accept loop
+			self.request.do_handshake()
+
+	def reply(self, code):
+		self.send_response(code)
+		self.send_header('Content-Length', '0')
+		self.end_headers()
+
+	def do_POST(self):
+		if self.path != self.server.path:
+			self.close_connection = True
+			self.reply(404)
+			return
+
+		secret = self.headers.get(SECRET_HEADER, '')
+		if not hmac.compare_digest(secret.encode('utf-8'), self.server.secret_token):
+			self.close_connection = True
+			self.reply(403)
+			return
+
+		try:
+			length = int(self.headers['Content-Length'])
+		except (TypeError, ValueError): # Missing or malformed
+			self.close_connection = True
+			self.reply(411)
+			return
+
+		if length < 0 or length > self.server.max_body_size:
+			# The body is not read, so the connection can't be reused
+			self.close_connection = True
+			self.reply(413)
+			return
+
+		try:
+			update = json.loads(self.rfile.read(length).decode('utf-8'))
+		except ValueError:
+			self.reply(400)
+			return
+		if not isinstance(update, dict):
+			self.reply(400)
+			return
+
+		with self.server.slots: # Limits the updates handled at the same time
+			try:
+				self.server.handle_update(update)
+			except Exception:
+				# Answering with an error would only make Telegram send it again
+				logger.exception('Error while handling update %s', update.get('update_id'))
+
+		self.reply(200)
+
+	def log_message(self, format, *args):
+		logger.debug('%s - ' + format, self.address_string(), *args)
+
+class WebhookServer(http.server.ThreadingHTTPServer):
+	"""
+	Receives the updates POSTed to path with the given secret token and calls
+	handle_update with each one of them, decoded into a dictionary. At most
+	workers updates are handled at the same time, and connections over
+	max_connections are closed. If ssl_context is given, the connections are
+	served over TLS.
+	"""
+
+	def __init__(self, address, path, secret_token, handle_update, workers=MAX_WORKERS,
+	             max_connections=MAX_CONNECTIONS, max_body_size=MAX_BODY_SIZE, ssl_context=None):
+		super().__init__(address, WebhookHandler)
+		if ssl_context is not None:
+			self.socket = ssl_context.wrap_socket(self.socket, server_side=True,
+			                                      do_handshake_on_connect=False)
+
+		self.path = path
+		self.secret_token = secret_token.encode('utf-8')
+		self.handle_update = handle_update
+		self.max_body_size = max_body_size
+		self.max_connections = max_connections
+		self.slots = threading.BoundedSemaphore(workers)
+		self.connections = set()
+		self.connections_lock = threading.Lock()
+
+	def process_request(self, request, client_address):
+		# Runs in the accept loop, before the thread of the connection is started
+		with self.connections_lock:
+			full = len(self.connections) >= self.max_connections
+			if not full:
+				self.connections.add(request)
+		if full:
+			logger.warning('Too many connections, closing the one from %s', client_address)
+			self.shutdown_request(request)
+			return
+
+		try:
+			super().process_request(request, client_address)
+		except Exception:
+			with self.connections_lock:
+				self.connections.discard(request)
+			raise
+
+	def process_request_thread(self, request, client_address):
+		try:
+			super().process_request_thread(request, client_address)
+		finally:
+			with self.connections_lock:
+				self.connections.discard(request)
+
+	def handle_error(self, request, client_address):
+		# Timeouts, resets and failed handshakes, which are not worth a traceback
+		logger.debug('Error in the connection from %s', client_address, exc_info=True)
+
+	def server_close(self):
+		super().server_close()
+		# Wakes up the threads waiting on idle connections
+		with self.connections_lock:
+			for request in self.connections:
+				try:
+					request.shutdown(socket.SHUT_RDWR)
+				except OSError:
+					pass